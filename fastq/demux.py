@@ -1,15 +1,21 @@
 import os
 import csv
 import math
+import shutil
 import dnaio
+import numpy as np
 import parasail
 import editdistance
-import re
+from collections import Counter
+from xopen import xopen
+import queue
 import logging
 import datetime
+import threading
 from .processor import FASTQProcessor, FASTQWorker
 from ..fastq_pair import ReadPair
 from ..fastq_file import IlluminaFASTQ, BarcodeStatistics
+from ..genomics.sequence import pack_sequences, packed_hamming, UNKNOWN_CODE, BASE_CODES, MAX_PACKED_LENGTH
 logger = logging.getLogger(__name__)
 
 
@@ -22,12 +28,17 @@ class DemultiplexWriter(dict):
     In the dictionary:
     Each key is a barcode.
     The actual filenames are specified by the paired_end_filenames() method.
-    Each value is a file-like object returned by opening a pair of fastq.gz files.
+    Each value is a 2-tuple of file-like objects returned by opening a pair of fastq.gz files.
 
     Attributes:
         barcode_dict: A dictionary mapping barcode to filename prefix.
-        prefix_dict: A dictionary mapping filename prefix to file-like object.
+        prefix_dict: A dictionary mapping filename prefix to a 2-tuple of file-like objects.
             prefix_dict can be used to determine the files with certain prefix are opened.
+        buffers: A dictionary mapping each 2-tuple of file-like objects to a list of read pairs to be written.
+        buffered: The total number of read pairs in the buffers.
+        BUFFER_SIZE: The max total number of read pairs buffered for all pairs of files.
+            When the limit is reached, the buffered reads are formatted and written into each pair of files at once.
+            The memory usage is bounded by BUFFER_SIZE regardless of the number of barcodes.
 
     This class supports context manager, for example:
         with DemultiplexWriter(barcode_dict) as writer:
@@ -39,6 +50,8 @@ class DemultiplexWriter(dict):
 
     BARCODE_NOT_MATCHED = "NO_MATCH"
 
+    BUFFER_SIZE = 4096
+
     @staticmethod
     def paired_end_filenames(prefix):
         """Maps a prefix to a 2-tuple of filenames (R1, R2)
@@ -52,6 +65,14 @@ class DemultiplexWriter(dict):
         """
         return prefix + ".R1.fastq.gz", prefix + ".R2.fastq.gz"
 
+    @staticmethod
+    def format_reads(reads):
+        """Formats a list of reads (dnaio Sequence objects) as FASTQ data (bytes).
+        """
+        return "".join([
+            "@" + read.name + "\n" + read.sequence + "\n+\n" + read.qualities + "\n" for read in reads
+        ]).encode("ascii")
+
     def __init__(self, barcode_dict):
         """Initializes the writer with a dictionary mapping barcode to filename prefix.
 
@@ -66,6 +87,8 @@ class DemultiplexWriter(dict):
         """
         self.barcode_dict = barcode_dict
         self.prefix_dict = {}
+        self.buffers = {}
+        self.buffered = 0
         super().__init__()
 
     def open(self):
@@ -74,26 +97,44 @@ class DemultiplexWriter(dict):
         for barcode, prefix in self.barcode_dict.items():
             if not prefix:
                 self[barcode] = None
+                continue
             if prefix in self.prefix_dict.keys():
                 self[barcode] = self.prefix_dict[prefix]
             else:
                 r1_out, r2_out = DemultiplexWriter.paired_end_filenames(prefix)
-                fp = dnaio.open(r1_out, file2=r2_out, mode='w')
+                fp = (xopen(r1_out, 'wb'), xopen(r2_out, 'wb'))
                 self.prefix_dict[prefix] = fp
+                self.buffers[fp] = []
                 self[barcode] = fp
         return self
 
+    def flush(self):
+        """Writes the buffered read pairs into the files.
+        """
+        for fp, buffer in self.buffers.items():
+            if not buffer:
+                continue
+            fp[0].write(self.format_reads([read_pair[0] for read_pair in buffer]))
+            fp[1].write(self.format_reads([read_pair[1] for read_pair in buffer]))
+            buffer.clear()
+        self.buffered = 0
+
     def close(self):
-        """Closes the files
+        """Writes the buffered read pairs and closes the files
         """
-        for fp in self.values():
-            fp.close()
+        self.flush()
+        for fp in self.prefix_dict.values():
+            fp[0].close()
+            fp[1].close()
 
     def write(self, barcode, read1, read2):
         fp = self.get(barcode)
         if not fp:
             return
-        fp.write(read1, read2)
+        self.buffers[fp].append((read1, read2))
+        self.buffered += 1
+        if self.buffered >= self.BUFFER_SIZE:
+            self.flush()
 
     def __enter__(self):
         return self.open()
@@ -107,6 +148,14 @@ class DemultiplexWorker(FASTQWorker):
     """
     DEFAULT_ERROR_RATE = 0.1
 
+    # The number of batches to be fetched from the in_queue ahead of processing
+    PREFETCH_SIZE = 2
+    # Seconds for the prefetch thread to wait on the queues before checking whether it should stop
+    PREFETCH_TIMEOUT = 1
+
+    # Score matrices shared by the workers in the same process, keyed by (score, penalty)
+    score_matrices = {}
+
     def __init__(self, barcode_dict, error_rate=None, score=1, penalty=10):
         """Initialize a demultiplex worker process.
 
@@ -134,23 +183,59 @@ class DemultiplexWorker(FASTQWorker):
         ))
 
         self.score_matrix = self.create_score_matrix()
+        # Counts of the batch being processed.
+        # process_read_pair() increments the counts here and start() merges them into self.counts after each batch.
+        self.batch_counts = Counter()
 
     def create_score_matrix(self):
         """Creates a parasail score matrix for alignment
+        The matrix is cached and shared by workers with the same score and penalty.
         """
-        return parasail.matrix_create("ACGTN", self.score, -1 * self.penalty)
+        key = (self.score, self.penalty)
+        score_matrix = DemultiplexWorker.score_matrices.get(key)
+        if score_matrix is None:
+            score_matrix = parasail.matrix_create("ACGTN", self.score, -1 * self.penalty)
+            DemultiplexWorker.score_matrices[key] = score_matrix
+        return score_matrix
 
     def semi_global_distance(self, s1, s2):
-        score_matrix = self.create_score_matrix()
         result = parasail.sg_de_stats(
-            s1, s2, self.penalty, self.penalty, score_matrix
+            s1, s2, self.penalty, self.penalty, self.score_matrix
         )
         return (self.score * result.matches - result.score) / self.penalty
 
+    @staticmethod
+    def prefetch(in_queue, local_queue, stop):
+        """Moves batches of reads from in_queue to local_queue until a None is received or stop is set.
+
+        The queues are polled with PREFETCH_TIMEOUT, so that the thread stops shortly after stop is set.
+        A batch held by the thread when it stops is discarded.
+        """
+        while not stop.is_set():
+            try:
+                reads = in_queue.get(timeout=DemultiplexWorker.PREFETCH_TIMEOUT)
+            except queue.Empty:
+                continue
+            while not stop.is_set():
+                try:
+                    local_queue.put(reads, timeout=DemultiplexWorker.PREFETCH_TIMEOUT)
+                    break
+                except queue.Full:
+                    continue
+            if reads is None:
+                return
+
     def start(self, in_queue, out_queue):
         """Starts the demultiplexing to process reads from in_queue.
         The number of reads processed are put into the out_queue for counting purpose.
 
+        The batches are fetched from in_queue by a separated thread
+            and held in a bounded local queue with at most PREFETCH_SIZE batches,
+            so that the IPC latency of in_queue overlaps with the processing of the reads.
+            The prefetch thread is stopped when this method returns or raises an exception.
+            If the processing fails, the batches fetched but not yet processed are discarded,
+            as FASTQProcessor.wait_for_jobs() aborts the whole run once a worker fails.
+
         Args:
             in_queue: A queue holding list of reads to be processed.
                 Each item in the in_queue is a list reads so that the frequency of access the queue are reduced.
@@ -161,34 +246,47 @@ class DemultiplexWorker(FASTQWorker):
         """
         active_time = datetime.timedelta()
         batch_count = 0
-        with DemultiplexWriter(self.barcode_dict) as writer:
-            while True:
-                reads = in_queue.get()
-                # Keep the starting time for each batch processing
-                timer_started = datetime.datetime.now()
-                if reads is None:
-                    batch_time = (active_time / batch_count) if batch_count else 0
-                    logger.debug("Process %s, Active time: %s (%s batches, %s/batch)." % (
-                        os.getpid(), active_time, batch_count, batch_time
-                    ))
-                    return self.counts
-                # results = []
-                for read_pair in reads:
-                    barcode, read1, read2 = self.process_read_pair(read_pair)
-                    writer.write(barcode, read1, read2)
-                    # results.append(result)
-
-                self.add_count('total', len(reads))
-                batch_count += 1
-                # Add processing time for this batch
-                active_time += (datetime.datetime.now() - timer_started)
-                out_queue.put(len(reads))
+        local_queue = queue.Queue(maxsize=self.PREFETCH_SIZE)
+        stop = threading.Event()
+        prefetch_thread = threading.Thread(
+            target=DemultiplexWorker.prefetch, args=(in_queue, local_queue, stop), daemon=True
+        )
+        prefetch_thread.start()
+        try:
+            with DemultiplexWriter(self.barcode_dict) as writer:
+                while True:
+                    reads = local_queue.get()
+                    # Keep the starting time for each batch processing
+                    timer_started = datetime.datetime.now()
+                    if reads is None:
+                        batch_time = (active_time / batch_count) if batch_count else 0
+                        logger.debug("Process %s, Active time: %s (%s batches, %s/batch)." % (
+                            os.getpid(), active_time, batch_count, batch_time
+                        ))
+                        return self.counts
+                    # results = []
+                    self.batch_counts = Counter()
+                    for read_pair in reads:
+                        barcode, read1, read2 = self.process_read_pair(read_pair)
+                        writer.write(barcode, read1, read2)
+                        # results.append(result)
+
+                    self.add_counts(self.batch_counts)
+                    self.add_count('total', len(reads))
+                    batch_count += 1
+                    # Add processing time for this batch
+                    active_time += (datetime.datetime.now() - timer_started)
+                    out_queue.put(len(reads))
+        finally:
+            stop.set()
+            prefetch_thread.join()
 
     def process_read_pair(self, read_pair):
         """Process the read pair
 
         Sub-class should implement this method to return a 3-tuple, i.e.
             (BARCODE, READ1, READ2)
+        The statistics should be counted in self.batch_counts.
 
         """
         raise NotImplementedError
@@ -217,6 +315,58 @@ class DemultiplexInlineWorker(DemultiplexWorker):
     """
     DEFAULT_ERROR_RATE = 0.2
 
+    # The number of read pairs processed between re-ordering the adapters by their hits
+    REORDER_INTERVAL = 100000
+
+    def __init__(self, barcode_dict, error_rate=None, score=1, penalty=10):
+        super().__init__(barcode_dict, error_rate, score, penalty)
+        # Query profiles of the adapters for semi-global alignment.
+        # Each profile is created once and reused for all reads.
+        self.adapter_profiles = [
+            parasail.profile_create_stats_sat(adapter, self.score_matrix) for adapter in self.adapters
+        ]
+        # Max distance allowed for each adapter
+        self._max_distance = [math.floor(len(adapter) * self.error_rate) for adapter in self.adapters]
+        # A list of 3-tuples, (adapter, profile, max_distance), in the order of matching.
+        # Keeping the values in a single list makes sure they stay in sync when re-ordering.
+        self._adapters = list(zip(self.adapters, self.adapter_profiles, self._max_distance))
+        # Number of reads matching each adapter since the worker started
+        self._hits = dict.fromkeys(self.adapters, 0)
+        self._reads_since_reorder = 0
+        self._adaptive = self.adapters_exclusive()
+        # Keys for counting the forward and reverse-compliment reads matching each adapter
+        self._key1 = {adapter: adapter + "_1" for adapter in self.adapters}
+        self._key2 = {adapter: adapter + "_2" for adapter in self.adapters}
+        logger.debug("Process %s, Adaptive adapter order: %s" % (os.getpid(), self._adaptive))
+
+    def adapters_exclusive(self):
+        """Checks if a read can possibly match more than one adapter.
+
+        If read R matches adapter A with distance at most d(A), a prefix P of R is within d(A) edits of A,
+            and the length of P differs from the length of A by at most d(A).
+        Two prefixes of the same read are within |len(P1) - len(P2)| edits of each other.
+        Therefore, by triangle inequality,
+            a read can match both A and B only if
+            editdistance(A, B) <= 2 * (d(A) + d(B)) + |len(A) - len(B)|
+
+        Returns: True if no read can match more than one adapter.
+            In that case the order of trying the adapters does not affect the results.
+
+        """
+        for i in range(len(self.adapters)):
+            for j in range(i + 1, len(self.adapters)):
+                a, b = self.adapters[i], self.adapters[j]
+                limit = 2 * (self._max_distance[i] + self._max_distance[j]) + abs(len(a) - len(b))
+                if editdistance.eval(a, b) <= limit:
+                    return False
+        return True
+
+    def reorder_adapters(self):
+        """Sorts the adapters by the number of hits so that the most common adapters are tried first.
+        """
+        self._adapters.sort(key=lambda t: self._hits[t[0]], reverse=True)
+        self._reads_since_reorder = 0
+
     def trim_adapters(self, read1, read2):
         """Checks if the beginning of the reads in a read pair matches any adapter.
         If so, trim the reads to remove the matching adapter.
@@ -232,10 +382,13 @@ class DemultiplexInlineWorker(DemultiplexWorker):
         They are passed into this method as references.
         The modifications on read1 and read2 will be preserved after return.
 
-        The score_matrix will be generated if not specified.
-        However, if specified, it must be generated by:
-            score_matrix = parasail.matrix_create("ACGTN", self.score, -1 * self.penalty)
-        Pass a score_matrix avoid this method to generate it every time, which may speed up the overall processing.
+        The alignments use the adapter profiles (self.adapter_profiles) created with self.score_matrix,
+            so that the adapters are not encoded again for every read.
+
+        When no read can match more than one adapter (see adapters_exclusive()),
+            the adapters are re-ordered by their hits every REORDER_INTERVAL read pairs,
+            so that the most common adapters are tried first.
+            Otherwise the adapters are always tried in the order of self.adapters.
 
         Returns: A 2-tuple indicating whether any adapters are matching the read pair.
             If a read matched an adapter, the matching adapter will be returned in the tuple.
@@ -253,19 +406,24 @@ class DemultiplexInlineWorker(DemultiplexWorker):
         matched = [""] * len(reads)
         for i in range(len(reads)):
             read = reads[i]
-            for adapter in self.adapters:
-                result = parasail.sg_de_stats(
-                    adapter, read.sequence[:20], self.penalty, self.penalty, self.score_matrix
+            head = read.sequence[:20]
+            for adapter, profile, max_distance in self._adapters:
+                result = parasail.sg_de_stats_striped_profile_sat(
+                    profile, head, self.penalty, self.penalty
                 )
                 if result.matches <= self.min_match_length:
                     continue
                 distance = (self.score * result.matches - result.score) / self.penalty
-                max_distance = math.floor(len(adapter) * self.error_rate)
                 if distance <= max_distance:
                     matched[i] = adapter
+                    self._hits[adapter] += 1
                     read.sequence = read.sequence[result.end_ref + 1:]
                     read.qualities = read.qualities[result.end_ref + 1:]
                     break
+        if self._adaptive:
+            self._reads_since_reorder += 1
+            if self._reads_since_reorder >= self.REORDER_INTERVAL:
+                self.reorder_adapters()
         # read1 and read2 are preserved implicitly
         return matched[0], matched[1]
 
@@ -277,32 +435,100 @@ class DemultiplexInlineWorker(DemultiplexWorker):
         # The modifications on read1 and read2 will be returned implicitly
         adapter1, adapter2 = self.trim_adapters(read1, read2)
 
+        counts = self.batch_counts
         if adapter1:
-            self.add_count("%s_1" % adapter1)
+            counts[self._key1[adapter1]] += 1
         if adapter2:
-            self.add_count("%s_2" % adapter2)
+            counts[self._key2[adapter2]] += 1
 
         # The longer adapter has higher priority
         adapter = adapter1 if len(adapter1) > len(adapter2) else adapter2
         if adapter:
             # Count the number of reads matching the longer adapter
-            self.add_count(adapter)
+            counts[adapter] += 1
             # Sequence matched a barcode
-            self.add_count('matched')
+            counts['matched'] += 1
 
         else:
             # Sequence does not match a barcode
-            self.add_count('unmatched')
+            counts['unmatched'] += 1
             adapter = DemultiplexWriter.BARCODE_NOT_MATCHED
         return adapter, read1, read2
 
 
 class DemultiplexDualIndexWorker(DemultiplexWorker):
+    # Max number of barcodes in the cache of matching results
+    MAX_CACHE_SIZE = 100000
+
     def __init__(self, barcode_dict, error_rate=None, score=1, penalty=10):
         super().__init__(barcode_dict, error_rate, score, penalty)
         self.max_error = {adapter: math.floor(len(adapter) * self.error_rate) for adapter in self.adapters}
 
+        # For strings with the same length, the edit distance is less than 2 if and only if
+        # the hamming distance is less than 2.
+        # When all adapters have the same length and the max error is not greater than 2,
+        # barcodes with the same length are matched by hamming distance against all adapters at once.
+        # The adapters are packed into 64-bit integers (3 bits per base) for the comparison.
+        self.adapter_length = None
+        self.packed_adapters = None
+        self.max_error_array = None
+        adapter_lengths = set(len(adapter.encode()) for adapter in self.adapters)
+        if len(adapter_lengths) == 1 and max(self.max_error.values()) <= 2:
+            adapter_length = adapter_lengths.pop()
+            adapter_array = np.frombuffer(
+                "".join(self.adapters).encode(), dtype=np.uint8
+            ).reshape(len(self.adapters), adapter_length)
+            # Adapters with unknown bases cannot be compared after packing.
+            if adapter_length <= MAX_PACKED_LENGTH and BASE_CODES[adapter_array].max() < UNKNOWN_CODE:
+                self.adapter_length = adapter_length
+                self.packed_adapters = pack_sequences(adapter_array)
+                self.max_error_array = np.array([self.max_error[adapter] for adapter in self.adapters])
+
+        # Matching results of the barcodes identical to the adapters,
+        # so that exact matches are resolved by a single dictionary lookup.
+        self.exact_matches = {adapter: self.__match_adapters(adapter) for adapter in self.adapters}
+        # Cache of the resolved barcodes, where each key is a raw barcode from the read name and
+        # each value is the matching adapter (or None).
+        self.barcode_cache = {}
+
     def match_adapters(self, barcode):
+        """Matches a barcode to the adapters.
+
+        Returns: The first adapter in self.adapters matching the barcode, or None if there is no match.
+
+        """
+        if barcode in self.exact_matches:
+            return self.exact_matches[barcode]
+        return self.__match_adapters(barcode)
+
+    def resolve_barcode(self, barcode):
+        """Resolves a raw barcode from the read name to the matching adapter.
+        The results are cached as the same barcodes appear in many reads.
+
+        Returns: The matching adapter, or None if there is no match.
+
+        """
+        try:
+            return self.barcode_cache[barcode]
+        except KeyError:
+            pass
+        if IlluminaFASTQ.is_dual_index(barcode):
+            adapter = self.match_adapters(IlluminaFASTQ.convert_barcode(barcode))
+        else:
+            adapter = self.match_adapters(barcode)
+        if len(self.barcode_cache) < self.MAX_CACHE_SIZE:
+            self.barcode_cache[barcode] = adapter
+        return adapter
+
+    def __match_adapters(self, barcode):
+        if self.packed_adapters is not None:
+            barcode_bytes = barcode.encode()
+            if len(barcode_bytes) == self.adapter_length:
+                packed_barcode = pack_sequences(np.frombuffer(barcode_bytes, dtype=np.uint8).reshape(1, -1))
+                mismatches = packed_hamming(self.packed_adapters, packed_barcode)
+                matched = np.flatnonzero(mismatches < self.max_error_array)
+                return self.adapters[matched[0]] if matched.size else None
+
         # barcode_i7, barcode_i5 = barcode.split("+", 1)
 
         for adapter in self.adapters:
@@ -319,16 +545,13 @@ class DemultiplexDualIndexWorker(DemultiplexWorker):
 
     def process_read_pair(self, read_pair):
         read1, read2 = read_pair
-        barcode = ReadPair(read1, read2).barcode
-        if re.match(IlluminaFASTQ.dual_index_pattern, barcode):
-            barcode = IlluminaFASTQ.convert_barcode(barcode)
-        barcode = self.match_adapters(barcode)
+        barcode = self.resolve_barcode(ReadPair(read1, read2).barcode)
         if not barcode:
             # TODO: Write unmatched reads.
-            self.add_count("unmatched")
+            self.batch_counts["unmatched"] += 1
             return DemultiplexWriter.BARCODE_NOT_MATCHED, read1, read2
-        self.add_count('matched')
-        self.add_count(barcode)
+        self.batch_counts['matched'] += 1
+        self.batch_counts[barcode] += 1
         return barcode, read1, read2
 
 
@@ -370,7 +593,9 @@ class DemultiplexProcess(FASTQProcessor):
                 if output_dict.get(barcode)
             ])
             prefix_dict[file_prefix] = path_list
-        prefix_dict = {k: list(set(v)) for k, v in prefix_dict.items()}
+        # Remove the duplicated paths while keeping the order of the output_list,
+        # so that the reads are concatenated in the same order every time.
+        prefix_dict = {k: list(dict.fromkeys(v)) for k, v in prefix_dict.items()}
         return prefix_dict
 
     @staticmethod
@@ -382,13 +607,29 @@ class DemultiplexProcess(FASTQProcessor):
             r1, r2 = DemultiplexWriter.paired_end_filenames(prefix)
             pair_list = [DemultiplexWriter.paired_end_filenames(p) for p in prefix_list]
 
-            cmd = "cat %s > %s" % (" ".join(p[0] for p in pair_list), r1)
-            os.system(cmd)
+            DemultiplexProcess.concatenate_files([p[0] for p in pair_list], r1)
             logger.debug(r1)
-            cmd = "cat %s > %s" % (" ".join(p[1] for p in pair_list), r2)
-            os.system(cmd)
+            DemultiplexProcess.concatenate_files([p[1] for p in pair_list], r2)
             logger.debug(r2)
 
+    # Buffer size for copying files in concatenate_files()
+    COPY_BUFFER_SIZE = 1 << 20
+
+    @staticmethod
+    def concatenate_files(file_list, output):
+        """Concatenates a list of files into one output file.
+        The files are copied as bytes, which gives a valid gzip file if the files are gzip compressed.
+
+        Args:
+            file_list: A list of file paths.
+            output: The path of the output file.
+
+        """
+        with open(output, "wb") as f_out:
+            for file_path in file_list:
+                with open(file_path, "rb") as f_in:
+                    shutil.copyfileobj(f_in, f_out, DemultiplexProcess.COPY_BUFFER_SIZE)
+
     @staticmethod
     def parse_barcode_outputs(barcode_outputs):
         """Parses the barcode and output file prefix pairs specified as a list of strings like:
@@ -461,8 +702,8 @@ class DemultiplexDualIndex(DemultiplexProcess):
         counter = 0
         with dnaio.open(r1) as fastq_in:
             for read1 in fastq_in:
-                barcode = read1.name.strip().split(":")[-1]
-                if re.match(IlluminaFASTQ.dual_index_pattern, barcode):
+                barcode = read1.name.rstrip().rpartition(":")[2]
+                if IlluminaFASTQ.is_dual_index(barcode):
                     barcode = IlluminaFASTQ.convert_barcode(barcode)
                 c = barcode_counts.get(barcode, 0)
                 c += 1
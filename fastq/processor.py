@@ -32,6 +32,13 @@ class FASTQWorker:
         self.counts[key] = c
         return self.counts
 
+    def add_counts(self, counts):
+        """Adds the values in a dictionary (e.g. a Counter of a batch) to self.counts
+        """
+        for key, val in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + val
+        return self.counts
+
     def start(self, in_queue, out_queue):
         """Starts processing reads from in_queue.
         The number of reads processed are put into the out_queue for counting purpose.
@@ -1,14 +1,49 @@
+import io
 import os
 import re
 import gzip
+import heapq
 import json
+import mmap
 import logging
+import functools
+import queue
+import itertools
+import threading
+import multiprocessing
+import dnaio
+import numpy as np
+try:
+    # ISA-L provides a faster drop-in replacement of the zlib module.
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from xopen import xopen
 from Aries.storage import StorageFile
 from Aries.visual.plotly import PlotlyFigure
 from Aries.collections import sort_lists
-from .genomics.sequence import Sequence
+from .genomics.sequence import Sequence, BASE_CODES, pack_codes, unpack_sequences
 logger = logging.getLogger(__name__)
 
+# Dual index barcode, i.e. 8bp I7 + 8bp I5, e.g. GCACAACT+CAAGTCGT
+# The translation table maps A, C, G, T and N to 0, "+" to 1 and any other byte to 2.
+# A dual index barcode translates to _DUAL_INDEX_MASK.
+_DUAL_INDEX_TABLE = bytes(0 if c in b"ACGTN" else 1 if c == ord("+") else 2 for c in range(256))
+_DUAL_INDEX_MASK = b"\x00" * 8 + b"\x01" + b"\x00" * 8
+# Length of the dual index barcode, including the "+"
+_DUAL_INDEX_LENGTH = len(_DUAL_INDEX_MASK)
+# 3-bit code of each byte for the barcode counting kernel, as used by pack_sequences(),
+# i.e. 0 to 4 for A, C, G, T and N, 5 for "+" and 7 for any other byte.
+# A single lookup validates and encodes the barcodes.
+_BARCODE_CODES = BASE_CODES.astype(np.uint8)
+# Positions of the bases in a dual index barcode
+_DUAL_INDEX_BASES = np.frombuffer(_DUAL_INDEX_MASK, dtype=np.uint8) == 0
+# ASCII whitespaces, which are stripped from the end of the identifier lines.
+_WHITESPACES = np.zeros(256, dtype=bool)
+_WHITESPACES[np.frombuffer(b" \t\r\x0b\x0c", dtype=np.uint8)] = True
+
 
 class ReadIdentifier:
     """Parses the identifier line of a read sequence from a FASTQ file.
@@ -116,45 +151,250 @@ class FASTQGzip:
         else:
             raise StopIteration
 
+    # Number of bytes to be decompressed at a time when counting the reads.
+    BLOCK_SIZE = 1 << 20
+
     @property
     def read_count(self):
+        """The number of reads in the file.
+        The reads are counted by the number of lines without parsing the reads.
+        """
         logger.debug("Counting reads in file %s..." % self.uri)
-        self.gzip = gzip.GzipFile(fileobj=StorageFile.init(self.uri, "rb").local())
-        return len(list(self))
+        line_count = 0
+        block = b""
+        with gzip.GzipFile(fileobj=StorageFile.init(self.uri, "rb").local()) as f:
+            while True:
+                last_block = block
+                block = f.read(self.BLOCK_SIZE)
+                if not block:
+                    break
+                line_count += block.count(b"\n")
+        # The last line may not end with a line break.
+        if last_block and not last_block.endswith(b"\n"):
+            line_count += 1
+        return (line_count + 3) // 4
+
+
+class RawGzipReader(io.RawIOBase):
+    """Reads a GZipped file by inflating the raw deflate stream of each gzip member.
+
+    Unlike the gzip module, the CRC32 and the size in the trailer of each member are skipped without verification.
+    A corrupted FASTQ file would still fail when parsing the reads.
+    Files with multiple members (e.g. concatenated fastq.gz files) and zero padding at the end are supported.
+    """
+
+    # Default size of each block read from the file
+    BUFFER_SIZE = 1 << 17
+
+    # Flags in the gzip header
+    FHCRC = 2
+    FEXTRA = 4
+    FNAME = 8
+    FCOMMENT = 16
+
+    def __init__(self, path, buffer_size=None):
+        self._file = open(path, "rb")
+        self._buffer_size = buffer_size if buffer_size else self.BUFFER_SIZE
+        # Compressed data read from the file but not yet decompressed
+        self._input = b""
+        # Decompressor of the current member, None before the header of a member is read
+        self._decompressor = None
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+    def _fill(self, size):
+        """Reads the file until there are at least size bytes in the input, or the end of the file is reached.
+
+        Returns: True if there are at least size bytes in the input.
+        """
+        while len(self._input) < size:
+            data = self._file.read(max(self._buffer_size, size - len(self._input)))
+            if not data:
+                return False
+            self._input += data
+        return True
+
+    def _skip(self, size):
+        if not self._fill(size):
+            raise EOFError("Compressed file ended before the end of the gzip header or trailer.")
+        self._input = self._input[size:]
+
+    def _skip_string(self):
+        """Skips a zero-terminated string in the gzip header.
+        """
+        while True:
+            end = self._input.find(b"\0")
+            if end >= 0:
+                self._input = self._input[end + 1:]
+                return
+            if not self._fill(len(self._input) + 1):
+                raise EOFError("Compressed file ended before the end of the gzip header.")
+
+    def _read_header(self):
+        """Reads the header of the next gzip member and starts a raw deflate decompressor.
+
+        Returns: False if there is no more member in the file.
+        """
+        # Skip the zero padding at the end of the file.
+        while True:
+            self._input = self._input.lstrip(b"\0")
+            if self._input or not self._fill(1):
+                break
+        if not self._input:
+            return False
+        if not self._fill(10):
+            raise EOFError("Compressed file ended before the end of the gzip header.")
+        if self._input[:2] != b"\x1f\x8b" or self._input[2] != 8:
+            raise OSError("Not a gzipped file (%r)" % self._input[:3])
+        flags = self._input[3]
+        self._input = self._input[10:]
+        if flags & self.FEXTRA:
+            if not self._fill(2):
+                raise EOFError("Compressed file ended before the end of the gzip header.")
+            self._skip(2 + int.from_bytes(self._input[:2], "little"))
+        if flags & self.FNAME:
+            self._skip_string()
+        if flags & self.FCOMMENT:
+            self._skip_string()
+        if flags & self.FHCRC:
+            self._skip(2)
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return True
+
+    def readinto(self, b):
+        while True:
+            if self._decompressor is None and not self._read_header():
+                return 0
+            if not self._input and not self._fill(1):
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached.")
+            data = self._decompressor.decompress(self._input, len(b))
+            self._input = self._decompressor.unconsumed_tail
+            if self._decompressor.eof:
+                # Skip the CRC32 and the size in the trailer of the member.
+                self._input = self._decompressor.unused_data
+                self._skip(8)
+                self._decompressor = None
+            if data:
+                b[:len(data)] = data
+                return len(data)
 
 
 class IlluminaFASTQ:
+    """Represents a FASTQ file from Illumina sequencer, in which the barcode is at the end of each identifier line.
+
+    Attributes:
+        CHUNK_SIZE: The number of bytes read from the file for each chunk in count_by_barcode()
+            and count_by_barcode_parallel(). The actual chunk is cut at the end of a read.
+            In count_by_barcode_parallel(), each chunk is processed by a worker process.
+        CHUNK_QUEUE_SIZE: The max number of chunks waiting in the queue between the reader thread
+            and the worker processes in count_by_barcode_parallel().
+    """
     processing_progress = {}
 
+    CHUNK_SIZE = 4 << 20
+    # Max number of chunks read ahead by the reader thread in count_by_barcode_parallel()
+    CHUNK_QUEUE_SIZE = 8
+
     dual_index_pattern = r"[ACGTN]{8}\+[ACGTN]{8}"
 
     def __init__(self, file_path):
-        file_path = str(file_path)
-        if not StorageFile(file_path).exists():
-            raise FileNotFoundError("File not found at %s." % file_path)
+        """Initializes the object with the path of a FASTQ file or a binary file-like object.
 
-        self.file_path = file_path
+        A file-like object (e.g. a stream of decompressed data) must contain uncompressed FASTQ data.
+        The file-like object is not closed by this class and can only be read once.
+        """
+        if hasattr(file_path, "read"):
+            self.file_obj = file_path
+            self.file_path = str(getattr(file_path, "name", ""))
+        else:
+            file_path = str(file_path)
+            if not StorageFile(file_path).exists():
+                raise FileNotFoundError("File not found at %s." % file_path)
+            self.file_obj = None
+            self.file_path = file_path
         logger.debug("Initialized Illumina FASTQ object.")
 
-    def peek_barcode(self):
-        barcode_dict = {}
+    @contextmanager
+    def _open_stream(self, threads=None):
+        """Opens the FASTQ file for iterating through the reads (dnaio Sequence objects).
+
+        Local files are opened by dnaio, which uses pigz to decompress fastq.gz files if available.
+        Other files (e.g. files on cloud storage) are streamed through StorageFile.
+
+        Args:
+            threads: The number of pigz threads for decompressing local files (see xopen).
+                Use 0 to decompress the file in the current process without starting pigz.
+
+        """
+        if self.file_obj is not None:
+            with dnaio.open(self.file_obj, fileformat="fastq") as reads:
+                yield reads
+            return
+        if os.path.exists(self.file_path):
+            opener = functools.partial(xopen, threads=threads)
+            with dnaio.open(self.file_path, fileformat="fastq", opener=opener) as reads:
+                yield reads
+            return
         with StorageFile.init(self.file_path, 'rb') as f:
-            with gzip.GzipFile(fileobj=f) as gz:
-                for i, line in enumerate(gz, start=1):
-                    if i > 4000:
-                        break
-                    # The line containing barcode starts with @
-                    if not line.startswith(b"@"):
-                        continue
-                    if isinstance(line, bytes):
-                        line = line.decode()
-                    # Raw barcode
-                    barcode = line.strip().split(":")[-1]
-
-                    if re.match(self.dual_index_pattern, barcode):
-                        barcode = self.convert_barcode(barcode)
-                        barcode_dict[barcode] = self.__count_barcode(barcode_dict, barcode, i)
-        return barcode_dict
+            if self.file_path.endswith(".gz"):
+                with gzip.GzipFile(fileobj=f) as gz, dnaio.open(gz, fileformat="fastq") as reads:
+                    yield reads
+            else:
+                with dnaio.open(f, fileformat="fastq") as reads:
+                    yield reads
+
+    @contextmanager
+    def _open_binary(self, threads=None):
+        """Opens the FASTQ file as a binary stream of uncompressed FASTQ data.
+
+        Local files are opened by xopen, which uses pigz to decompress fastq.gz files if available.
+        Other files (e.g. files on cloud storage) are streamed through StorageFile.
+        A file-like object given at initialization is used as is and it will not be closed.
+
+        Args:
+            threads: The number of pigz threads for decompressing local files (see xopen).
+
+        """
+        if self.file_obj is not None:
+            yield self.file_obj
+            return
+        if os.path.exists(self.file_path):
+            with xopen(self.file_path, "rb", threads=threads) as f:
+                yield f
+            return
+        with StorageFile.init(self.file_path, 'rb') as f:
+            if self.file_path.endswith(".gz"):
+                with gzip.GzipFile(fileobj=f) as gz:
+                    yield gz
+            else:
+                yield f
+
+    def peek_barcode(self):
+        """Counts the number of reads for each barcode in the first 1000 reads of the file.
+        """
+        # Only a small part of the file is needed, pigz is not used.
+        with self._open_stream(threads=0) as reads:
+            counter = self._count(itertools.islice(reads, 1000))
+        return self.__convert_keys(counter)
+
+    @staticmethod
+    def is_dual_index(barcode):
+        """Checks if a barcode is a dual index barcode (8bp I7 + 8bp I5).
+
+        Args:
+            barcode (bytes or str): The barcode to be checked.
+                Passing bytes avoids encoding the barcode on every call.
+
+        """
+        if isinstance(barcode, str):
+            barcode = barcode.encode()
+        return len(barcode) == 17 and barcode.translate(_DUAL_INDEX_TABLE) == _DUAL_INDEX_MASK
 
     @staticmethod
     def convert_barcode(barcode):
@@ -164,46 +404,55 @@ class IlluminaFASTQ:
         barcode = "%s+%s" % (i7, i5)
         return barcode
 
-    def __process_barcode(self, lines, method):
-        """
+    def _count(self, reads):
+        """Counts the number of reads for each raw dual index barcode.
 
         Args:
-            lines: Iterable lines from FASTQ file.
-            method: The method for processing the line containing the barcode.
+            reads: Iterable reads (dnaio Sequence objects) from FASTQ file.
 
-        Returns:
+        Returns: A Counter, where each key is a raw barcode (bytes).
 
         """
-        barcode_dict = {}
-        for i, line in enumerate(lines, start=1):
-            if i > 0 and i % 1000000 == 0:
-                logger.debug("%s reads processed." % round(i / 4))
-            # The line containing barcode starts with @
-            if not line.startswith("@"):
-                continue
-            # Raw barcode
-            barcode = line.strip().split(":")[-1]
+        counter = Counter()
+        for i, read in enumerate(reads, start=1):
+            if i % 1000000 == 0:
+                logger.debug("%s reads processed." % i)
+            # Raw barcode as bytes, the whitespaces at the end of the identifier are ignored.
+            barcode = read.name.rstrip().encode().rpartition(b":")[2]
+            if self.is_dual_index(barcode):
+                counter[barcode] += 1
+        return counter
+
+    def _group(self, reads):
+        """Groups the reads by raw dual index barcode.
 
-            if re.match(self.dual_index_pattern, barcode):
-                barcode = self.convert_barcode(barcode)
-                barcode_dict[barcode] = method(barcode_dict, barcode, i)
-        return barcode_dict
+        Args:
+            reads: Iterable reads (dnaio Sequence objects) from FASTQ file.
 
-    @staticmethod
-    def __count_barcode(barcode_dict, barcode, row_number):
-        """Increments the number of reads for a particular barcode
-        """
-        return barcode_dict.get(barcode, 0) + 1
+        Returns: A dictionary, where each key is a raw barcode (bytes) and
+            each value is a list of the row numbers of the identifier lines in the FASTQ file.
 
-    @staticmethod
-    def __group_barcode(barcode_dict, barcode, row_number):
-        line_list = barcode_dict.get(barcode, [])
-        line_list.append(row_number)
-        return line_list
+        """
+        groups = defaultdict(list)
+        for i, read in enumerate(reads, start=1):
+            if i % 1000000 == 0:
+                logger.debug("%s reads processed." % i)
+            # Raw barcode as bytes, the whitespaces at the end of the identifier are ignored.
+            barcode = read.name.rstrip().encode().rpartition(b":")[2]
+            if self.is_dual_index(barcode):
+                groups[barcode].append(4 * i - 3)
+        return groups
+
+    @classmethod
+    def __convert_keys(cls, barcode_dict):
+        """Converts the raw dual index barcodes (bytes) in the keys of a dictionary.
+        Each unique barcode is only decoded and converted once.
+        """
+        return {cls.convert_barcode(k.decode()): v for k, v in barcode_dict.items()}
 
     def group_by_barcode(self, threshold=0):
-        with open(self.file_path, 'r') as f:
-            barcode_dict = self.__process_barcode(f, self.__group_barcode)
+        with self._open_stream() as f:
+            barcode_dict = self.__convert_keys(self._group(f))
         if threshold > 0:
             barcode_dict = {k: v for k, v in barcode_dict.items() if len(v) > threshold}
         return barcode_dict
@@ -214,13 +463,224 @@ class IlluminaFASTQ:
         Args:
             threshold: Includes only barcodes with number of reads more than threshold.
 
-        Returns:
+        The data is read in chunks of complete reads and each chunk is counted by count_chunk(),
+            which processes all reads in the chunk with numpy instead of iterating through the reads in Python.
+
+        Returns: A dictionary, where each key is a barcode and each value is the number of reads.
+
+        """
+        counter = Counter()
+        logger.debug("Counting number of reads per barcode...")
+        for chunk in self.iterate_chunks():
+            self.merge_counts(counter, self.count_chunk(chunk))
+        barcode_dict = self.__convert_keys(self.unpack_barcodes(counter))
+        logger.debug("%s barcodes in the file" % len(barcode_dict))
+        return {k: v for k, v in barcode_dict.items() if v > threshold}
+
+    @staticmethod
+    def read_chunks(f, chunk_size):
+        """Reads a FASTQ file in chunks, each chunk contains only complete reads (4 lines per read).
+
+        Args:
+            f: A file object opened in binary mode.
+            chunk_size: The number of bytes to be read from the file for each chunk.
+
+        Returns: A generator of chunks (bytes).
+
+        """
+        # The data is read into a single buffer reused for all chunks.
+        # The incomplete read at the end of each chunk is moved to the beginning of the buffer.
+        buffer = bytearray(chunk_size)
+        filled = 0
+        eof = False
+        while not eof:
+            # Grow the buffer if it does not contain any complete read.
+            if filled == len(buffer):
+                buffer.extend(bytes(chunk_size))
+            with memoryview(buffer) as view:
+                while filled < len(buffer):
+                    size = f.readinto(view[filled:])
+                    if not size:
+                        eof = True
+                        break
+                    filled += size
+            line_count = buffer.count(b"\n", 0, filled)
+            extra = line_count % 4
+            if line_count == extra:
+                continue
+            # Find the line break at the end of the last complete read.
+            end = filled
+            for _ in range(extra + 1):
+                end = buffer.rfind(b"\n", 0, end)
+            end += 1
+            with memoryview(buffer) as view:
+                chunk = view[:end].tobytes()
+            buffer[:filled - end] = buffer[end:filled]
+            filled -= end
+            yield chunk
+        if filled:
+            yield bytes(buffer[:filled])
+
+    @staticmethod
+    def map_chunks(file_path, chunk_size):
+        """Maps an uncompressed local FASTQ file into memory and splits it into chunks of complete reads.
+
+        Args:
+            file_path: The path of an uncompressed local FASTQ file.
+            chunk_size: The approximate number of bytes in each chunk.
+
+        Returns: A generator of chunks, each chunk is a numpy array (uint8) viewing the mapped file without copying.
+
+        """
+        if not os.path.getsize(file_path):
+            return
+        # The mapping stays valid after closing the file.
+        # It is released when the chunks are no longer referenced.
+        with open(file_path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        data = np.frombuffer(mm, dtype=np.uint8)
+        start = 0
+        size = chunk_size
+        while start < len(data):
+            end = start + size
+            if end >= len(data):
+                yield data[start:]
+                break
+            line_count = np.count_nonzero(data[start:end] == ord("\n"))
+            extra = line_count % 4
+            if line_count == extra:
+                # Enlarge the chunk if it does not contain any complete read.
+                size += chunk_size
+                continue
+            # Find the line break at the end of the last complete read.
+            for _ in range(extra + 1):
+                end = mm.rfind(b"\n", start, end)
+            yield data[start:end + 1]
+            start = end + 1
+            size = chunk_size
+
+    def iterate_chunks(self):
+        """Iterates through the FASTQ file in chunks of complete reads.
+        An uncompressed local file is mapped into memory, other files are read by read_chunks().
+        """
+        if (self.file_obj is None and os.path.exists(self.file_path)
+                and not self.file_path.endswith((".gz", ".bz2", ".xz"))):
+            yield from self.map_chunks(self.file_path, self.CHUNK_SIZE)
+            return
+        with self._open_binary() as f:
+            yield from self.read_chunks(f, self.CHUNK_SIZE)
+
+    @staticmethod
+    def count_chunk(chunk):
+        """Counts the number of reads for each raw dual index barcode in a chunk of FASTQ data.
+
+        Args:
+            chunk (bytes-like): FASTQ data containing only complete reads.
+
+        Returns: A 2-tuple of numpy arrays, (barcodes, counts),
+            barcodes are the unique raw barcodes packed into integers by pack_sequences(),
+            counts are the number of reads for each barcode.
+            Use unpack_barcodes() to convert the packed barcodes back to raw barcodes.
+
+        """
+        data = np.frombuffer(chunk, dtype=np.uint8)
+        newlines = np.flatnonzero(data == ord("\n"))
+        if len(data) and data[-1] != ord("\n"):
+            newlines = np.append(newlines, len(data))
+        # Every 4th line is an identifier line.
+        ends = newlines[0::4]
+        starts = np.zeros_like(ends)
+        starts[1:] = newlines[3:len(newlines) - 1:4] + 1
+        # Strip the whitespaces at the end of the identifier lines.
+        while True:
+            spaces = (ends > starts) & _WHITESPACES[data[np.maximum(ends - 1, 0)]]
+            if not spaces.any():
+                break
+            ends -= spaces
+        # The last (barcode length + 1) bytes of each identifier line are gathered into a 2D array,
+        # in which each row is expected to be ":" followed by a dual index barcode.
+        width = _DUAL_INDEX_LENGTH + 1
+        tails = data[np.maximum(ends.reshape(-1, 1) + np.arange(-width, 0), 0)]
+        codes = _BARCODE_CODES[tails[:, 1:]]
+        # Lines shorter than the tail would include bytes of the previous line.
+        lengths = ends - starts
+        valid = (
+            (lengths >= width) & (tails[:, 0] == ord(":"))
+            & ((codes < 5) == _DUAL_INDEX_BASES).all(axis=1)
+            & (codes[:, ~_DUAL_INDEX_BASES] == 5).all(axis=1)
+        )
+        return np.unique(pack_codes(codes[valid]), return_counts=True)
+
+    @staticmethod
+    def merge_counts(counter, chunk_counts):
+        """Adds the (barcodes, counts) returned by count_chunk() into a Counter.
+        """
+        barcodes, counts = chunk_counts
+        counter.update(dict(zip(barcodes.tolist(), counts.tolist())))
+        return counter
+
+    @staticmethod
+    def unpack_barcodes(counter):
+        """Converts the keys of barcode counts from packed integers to raw barcodes (bytes).
+        """
+        packed = np.fromiter(counter.keys(), dtype=np.uint64, count=len(counter))
+        barcodes = unpack_sequences(packed, _DUAL_INDEX_LENGTH).view("S%d" % _DUAL_INDEX_LENGTH).ravel()
+        return dict(zip(barcodes.tolist(), counter.values()))
+
+    @classmethod
+    def enqueue_chunks(cls, f, chunk_queue):
+        """Reads the chunks of a FASTQ file into a queue.
+        A None is put into the queue after the last chunk.
+        If an exception occurs, the exception is put into the queue before the None.
+        """
+        try:
+            for chunk in cls.read_chunks(f, cls.CHUNK_SIZE):
+                chunk_queue.put(chunk)
+        except Exception as ex:
+            chunk_queue.put(ex)
+        chunk_queue.put(None)
+
+    def count_by_barcode_parallel(self, threads=None, threshold=0):
+        """Counts the number of reads for each barcode in the FASTQ file using multiple processes.
+
+        The file is decompressed by pigz (through xopen) if it is compressed.
+        The data is split into chunks of complete reads by a reader thread,
+            and the chunks are counted by a pool of processes.
+        The reader thread keeps reading and decompressing the data while the chunks are being counted.
+
+        Args:
+            threads: The number of processes for counting the barcodes, defaults to the number of CPUs.
+            threshold: Includes only barcodes with number of reads more than threshold.
+
+        Returns: A dictionary, where each key is a barcode and each value is the number of reads.
 
         """
-        with open(self.file_path, 'r') as f:
-            logger.debug("Counting number of reads per barcode...")
-            barcode_dict = self.__process_barcode(f, self.__count_barcode)
-        logger.debug("%s barcodes in the file" % len(barcode_dict.keys()))
+        if not threads:
+            threads = os.cpu_count() or 1
+        if threads < 2:
+            return self.count_by_barcode(threshold)
+
+        counter = Counter()
+        logger.debug("Counting number of reads per barcode with %s processes..." % threads)
+        with self._open_binary(threads) as f, multiprocessing.Pool(threads) as pool:
+            chunk_queue = queue.Queue(maxsize=self.CHUNK_QUEUE_SIZE)
+            reader = threading.Thread(target=self.enqueue_chunks, args=(f, chunk_queue), daemon=True)
+            reader.start()
+            jobs = deque()
+            for chunk in iter(chunk_queue.get, None):
+                if isinstance(chunk, Exception):
+                    raise chunk
+                jobs.append(pool.apply_async(IlluminaFASTQ.count_chunk, (chunk,)))
+                # Limit the number of chunks waiting to be processed, so that the memory usage is bounded.
+                if len(jobs) >= 2 * threads:
+                    self.merge_counts(counter, jobs.popleft().get())
+            while jobs:
+                self.merge_counts(counter, jobs.popleft().get())
+            reader.join()
+        barcode_dict = self.__convert_keys(self.unpack_barcodes(counter))
+        logger.debug("%s barcodes in the file" % len(barcode_dict))
         return {k: v for k, v in barcode_dict.items() if v > threshold}
 
 
@@ -254,6 +714,14 @@ class BarcodeStatistics:
         Returns: A 2-tuple: (Number of Reads, Barcode)
 
         """
+        if not self.barcode_dict:
+            return [], []
+        if max_size and len(self.barcode_dict) > max_size:
+            # Select the top items without sorting all the data.
+            # The results are the same as sorting the (count, barcode) tuples.
+            select = heapq.nlargest if reverse else heapq.nsmallest
+            top = select(max_size, ((v, k) for k, v in self.barcode_dict.items()))
+            return [t[0] for t in top], [t[1] for t in top]
         barcodes = []
         counts = []
         for k, v in self.barcode_dict.items():
@@ -52,8 +52,8 @@ class ReadPair:
         For Illumina sequencer, this is I7 + reverse compliment of I5.
 
         """
-        barcode1 = self.read1.name.strip().split(":")[-1]
-        barcode2 = self.read2.name.strip().split(":")[-1]
+        barcode1 = self.read1.name.rstrip().rpartition(":")[2]
+        barcode2 = self.read2.name.rstrip().rpartition(":")[2]
         if not barcode1 == barcode2:
             raise ValueError("Read1 and Read2 have different barcodes.\nRead1: %s\nRead2: %s" % (barcode1, barcode2))
         return barcode1
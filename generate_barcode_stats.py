@@ -1,13 +1,29 @@
+import io
+import os
 import sys
+import shutil
 import logging
+import tempfile
+import subprocess
 import json
-import gzip
 import argparse
+try:
+    # orjson encodes the barcode statistics much faster than the json module.
+    import orjson
+except ImportError:
+    orjson = None
 from datetime import datetime
 
-from .fastq_file import IlluminaFASTQ
+from .fastq_file import IlluminaFASTQ, RawGzipReader
 from Aries.storage import StorageFile
 
+# Size of each block read from the GZipped FASTQ file
+READ_BUFFER_SIZE = 1 << 17
+# Size of the pipe buffer for reading the decompressed data from pugz
+PIPE_BUFFER_SIZE = 1 << 20
+# Indicates whether configure_logging() has been called
+_configured = False
+
 
 def configure_argparser(argparser_obj):
 
@@ -25,6 +41,15 @@ def configure_argparser(argparser_obj):
                                required=True,
                                help="Path to JSON file to store the generated barcode stats")
 
+    # Size of each block read when decompressing the input file
+    argparser_obj.add_argument("-b", "--buffer-size",
+                               action="store",
+                               dest="buffer_size",
+                               type=int,
+                               required=False,
+                               default=READ_BUFFER_SIZE,
+                               help=argparse.SUPPRESS)
+
     # Verbosity
     argparser_obj.add_argument("-v",
                                action='count',
@@ -40,6 +65,14 @@ def configure_argparser(argparser_obj):
 
 
 def configure_logging(verbosity):
+    global _configured
+    # The log format and level names are only set up once, e.g. when main() is called repeatedly.
+    # Only the level of the logs is updated in the subsequent calls.
+    if _configured:
+        set_logging_level(verbosity)
+        return
+    _configured = True
+
     # Setting the format of the logs
     FORMAT = '[%(asctime)s]-[%(process)d] %(name)s -- %(levelname)s:%(message)s'
 
@@ -66,11 +99,16 @@ def configure_logging(verbosity):
         logging.addLevelName(logging.INFO, "GENERATE_BARCODE_STATS_INFO")
         logging.addLevelName(logging.DEBUG, "GENERATE_BARCODE_STATS_DEBUG")
 
+    set_logging_level(verbosity)
+
+
+def set_logging_level(verbosity):
     # Setting the level of the logs
     level = [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG][verbosity]
 
     logging.getLogger().setLevel(level)
 
+
 def main():
 
     # Authenticate with the cluster
@@ -89,7 +127,7 @@ def main():
 
     logger.info(f'Generating stats started on {start}')
 
-    _analyze_barcode(args.input_file, args.output_file, logger)
+    _analyze_barcode(args.input_file, args.output_file, logger, buffer_size=args.buffer_size)
 
     # end time of parsing
     end = datetime.now()
@@ -101,30 +139,87 @@ def main():
     logger.info(f'Parsing completed at {end}')
 
 
-def _analyze_barcode(gzip_fastq, json_stats, logger):
-    logger.debug(f"Analyzing barcode in {gzip_fastq}")
+def _set_pipe_size(fd, size, logger):
+    """Enlarges the kernel buffer of a pipe (Linux only), so that the writer is blocked less often.
+    """
+    try:
+        import fcntl
+        # F_SETPIPE_SZ is available in the fcntl module since Python 3.10
+        fcntl.fcntl(fd, getattr(fcntl, "F_SETPIPE_SZ", 1031), size)
+    except (ImportError, OSError) as ex:
+        logger.debug("Unable to set pipe size: %s" % ex)
+
+
+def _pugz_count(gzip_fastq, logger):
+    """Counts the reads by barcode while decompressing the GZipped FASTQ file with pugz.
+    The CPUs are split between the pugz threads and the counting processes, so that they do not compete for the CPUs.
+    The decompressed data is streamed from pugz through an unbuffered pipe,
+    i.e. the data is read from the pipe directly into the buffer of the FASTQ parser.
+
+    Returns: A dictionary of barcode counts, or None if pugz is not available or failed.
+    """
+    pugz = shutil.which("pugz")
+    if not pugz:
+        return None
+    cpu_count = os.cpu_count() or 1
+    pugz_threads = max(cpu_count // 2, 1)
+    count_threads = max(cpu_count - pugz_threads, 1)
+    logger.debug("Unzipping %s with pugz using %s threads..." % (gzip_fastq, pugz_threads))
+    # The error messages are written to a temporary file instead of a pipe,
+    # so that pugz cannot block on a full stderr pipe while stdout is being read.
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            [pugz, "-t", str(pugz_threads), gzip_fastq], stdout=subprocess.PIPE, stderr=stderr, bufsize=0
+        )
+        try:
+            _set_pipe_size(process.stdout.fileno(), PIPE_BUFFER_SIZE, logger)
+            barcode_stats = IlluminaFASTQ(process.stdout).count_by_barcode_parallel(count_threads)
+        except BaseException:
+            # Stop pugz if the counting failed or is interrupted.
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            process.wait()
+        if process.returncode != 0:
+            stderr.seek(0)
+            logger.warning("pugz failed (exit code %s): %s" % (process.returncode, stderr.read().decode().strip()))
+            return None
+    return barcode_stats
+
+
+def _gzip_count(gzip_fastq, logger, buffer_size=READ_BUFFER_SIZE):
+    """Counts the reads by barcode while decompressing the GZipped FASTQ file in blocks of buffer_size bytes.
+    The data is decompressed by RawGzipReader, which does not verify the CRC32 checksums.
+    """
+    logger.debug("Unzipping %s ..." % gzip_fastq)
+    with RawGzipReader(gzip_fastq, buffer_size) as gzip_file:
+        with io.BufferedReader(gzip_file, buffer_size=buffer_size) as fastq:
+            return IlluminaFASTQ(fastq).count_by_barcode_parallel()
+
+
+def _analyze_barcode(gzip_fastq, json_stats, logger, buffer_size=READ_BUFFER_SIZE):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Analyzing barcode in {gzip_fastq}")
 
     logger.debug("Counting reads by barcode...")
 
-    # fastq = File.unzip(gzip_fastq)
-    fastq = gzip_fastq.replace(".gz", "")
-
-    with gzip.open(gzip_fastq, 'rb') as gzip_file:
-        with open(fastq, "wb") as unzipped_file:
-            logger.debug("Unzipping %s to %s ..." % (gzip_fastq, fastq))
-            block_size = 1 << 20
-            while True:
-                block = gzip_file.read(block_size)
-                if not block:
-                    break
-                unzipped_file.write(block)
+    # The decompressed data is counted as a stream without writing the FASTQ file to disk.
+    barcode_stats = _pugz_count(gzip_fastq, logger)
+    if barcode_stats is None:
+        barcode_stats = _gzip_count(gzip_fastq, logger, buffer_size)
 
-    barcode_stats = IlluminaFASTQ(fastq).count_by_barcode()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Barcode count: {len(barcode_stats)}")
 
-    logger.debug(f"Barcode count: {len(barcode_stats.keys())}")
-
-    with StorageFile.init(json_stats, 'w') as fp:
-        json.dump(barcode_stats, fp)
+    # Encode the statistics first and write them in one call,
+    # so that a file on cloud storage is uploaded at once.
+    if orjson:
+        payload = orjson.dumps(barcode_stats)
+    else:
+        payload = json.dumps(barcode_stats).encode()
+    with StorageFile.init(json_stats, 'wb') as fp:
+        fp.write(payload)
 
     return json_stats
 
@@ -22,6 +22,82 @@ COMPLEMENTS = {
     "N": "N",
 }
 
+# 3-bit codes for packing sequences into 64-bit integers.
+# Characters other than A, C, G, T, N and "+" are encoded as UNKNOWN_CODE.
+BASE_CODES = np.full(256, 7, dtype=np.uint64)
+BASE_CODES[np.frombuffer(b"ACGTN+", dtype=np.uint8)] = np.arange(6, dtype=np.uint64)
+UNKNOWN_CODE = 7
+# ASCII character of each 3-bit code, UNKNOWN_CODE is decoded as "?".
+BASE_CHARS = np.frombuffer(b"ACGTN+??", dtype=np.uint8)
+# Max number of bases in a packed sequence.
+MAX_PACKED_LENGTH = 21
+# The lowest bit of each 3-bit code in a packed sequence.
+_LOW_BITS = np.uint64(sum(1 << (3 * i) for i in range(MAX_PACKED_LENGTH)))
+# Number of bits set in each byte.
+_BIT_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def pack_sequences(array):
+    """Packs sequences with the same length into 64-bit integers, 3 bits per base.
+
+    Args:
+        array: A 2-D numpy array of uint8, each row is a sequence encoded as ASCII bytes.
+            The sequences must not be longer than MAX_PACKED_LENGTH.
+
+    Returns: A 1-D numpy array of uint64.
+
+    """
+    return pack_codes(BASE_CODES[array])
+
+
+def pack_codes(codes):
+    """Packs sequences already encoded as 3-bit codes (see BASE_CODES) into 64-bit integers.
+
+    Args:
+        codes: A 2-D numpy array of integers, each row is a sequence encoded as 3-bit codes.
+            The sequences must not be longer than MAX_PACKED_LENGTH.
+
+    Returns: A 1-D numpy array of uint64.
+
+    """
+    length = codes.shape[1]
+    if length > MAX_PACKED_LENGTH:
+        raise ValueError("Sequences longer than %s bases cannot be packed." % MAX_PACKED_LENGTH)
+    shifts = np.arange(3 * (length - 1), -1, -3, dtype=np.uint64)
+    return np.bitwise_or.reduce(codes.astype(np.uint64) << shifts, axis=1)
+
+
+def unpack_sequences(packed, length):
+    """Unpacks 64-bit integers packed by pack_sequences() into sequences.
+
+    Args:
+        packed: A 1-D numpy array of uint64.
+        length: The number of bases in each packed sequence.
+
+    Returns: A 2-D numpy array of uint8, each row is a sequence encoded as ASCII bytes.
+
+    """
+    shifts = np.arange(3 * (length - 1), -1, -3, dtype=np.uint64)
+    codes = (np.asarray(packed, dtype=np.uint64).reshape(-1, 1) >> shifts) & np.uint64(UNKNOWN_CODE)
+    return BASE_CHARS[codes]
+
+
+def packed_hamming(packed1, packed2):
+    """Calculates the hamming distances between packed sequences.
+
+    Args:
+        packed1: Packed sequences (numpy array of uint64) returned by pack_sequences()
+        packed2: Packed sequences to be compared with packed1, or a single packed sequence.
+
+    Returns: A 1-D numpy array of the number of mismatched bases.
+
+    """
+    diff = np.bitwise_xor(packed1, packed2)
+    # Collapse each 3-bit code into its lowest bit, which is set if the bases are different.
+    diff = (diff | (diff >> np.uint64(1)) | (diff >> np.uint64(2))) & _LOW_BITS
+    diff = np.atleast_1d(diff)
+    return _BIT_COUNTS[diff.view(np.uint8)].reshape(len(diff), 8).sum(axis=1)
+
 
 class Distance:
     """Contains static functions for calculating distance between two sequences.
@@ -5,14 +5,11 @@ import logging
 import json
 import sys
 from Aries.outputs import LoggingConfig, PackageLogFilter
-from .basespace.cmd import basespace_command
-from .fastq_file import ReadIdentifier
-from .fastq_pair import FASTQPair
-from .fastq.demux import DemultiplexInline, DemultiplexDualIndex, DemultiplexWriter
-from .fastq.barcode import BarcodeCounter
-from .variants import files
 logger = logging.getLogger(__name__)
 
+# The argument parser is built once when main() is called for the first time.
+_PARSER = None
+
 
 class Program:
     """Contains static methods for sub-commands to start the processing program with args
@@ -23,6 +20,7 @@ class Program:
     def basespace(args):
         """Access information in BaseSpace
         """
+        from .basespace.cmd import basespace_command
         options = {
             "collection": args.collection,
             "basespace_id": args.basespace_id,
@@ -35,6 +33,7 @@ class Program:
     def demux_inline(args):
         """Demultiplex FASTQ files with inline barcode adapters.
         """
+        from .fastq.demux import DemultiplexInline, DemultiplexWriter
         if len(args.r1) != len(args.r2):
             raise ValueError("R1 and R2 must have the same number of files.")
 
@@ -53,6 +52,7 @@ class Program:
 
     @staticmethod
     def demux_barcode(args):
+        from .fastq.demux import DemultiplexDualIndex
         if len(args.r1) != len(args.r2):
             raise ValueError("R1 and R2 must have the same number of files.")
 
@@ -81,6 +81,7 @@ class Program:
     def compare_fastq(args):
         """Compare FASTQ files
         """
+        from .fastq_pair import FASTQPair
         if not os.path.exists(args.output):
             os.makedirs(args.output)
         FASTQPair(*args.FASTQ).diff(args.compare[0], args.compare[1], args.output, args.chunk_size)
@@ -89,6 +90,7 @@ class Program:
     def count_inline_barcode(args):
         """Counts the inline barcode
         """
+        from .fastq.barcode import BarcodeCounter
         if args.r2:
             if len(args.r1) != len(args.r2):
                 raise ValueError("R1 and R2 must have the same number of files.")
@@ -101,6 +103,7 @@ class Program:
 
     @staticmethod
     def filter_whitelist(args):
+        from .variants import files
         whitelist_path = str(args.whitelist)
         if whitelist_path.endswith(".vcf"):
             whitelist = files.VCFVariants(whitelist_path)
@@ -126,11 +129,14 @@ class Program:
 
     @staticmethod
     def parse_read_identifier(args):
+        from .fastq_file import ReadIdentifier
         read_id = ReadIdentifier(args.line)
         print(json.dumps(read_id.info, indent=4))
 
 
-def main():
+def build_parser():
+    """Builds the argument parser with a sub parser for each program.
+    """
     parser = argparse.ArgumentParser(description="Command line entry points to Cancer package.")
     subparsers = parser.add_subparsers(title="Program", help="Program", dest='program')
 
@@ -184,11 +190,19 @@ def main():
     sub_parser.add_argument('-s', '--start', type=int, default=0,
                             help="Starting position of the barcode (0-based), defaults to 0")
     sub_parser.add_argument('-l', '--length', type=int, required=True, help="Length of the barcode")
+    return parser
+
+
+def main():
+    global _PARSER
+    if _PARSER is None:
+        _PARSER = build_parser()
+    parser = _PARSER
 
     # Parse command
     args = parser.parse_args()
     # Show help if no subparser matched.
-    if not vars(args).keys() or not args.program or not hasattr(Program, args.program):
+    if not vars(args) or not args.program or not hasattr(Program, args.program):
         parser.parse_args(["-h"])
         return
 
@@ -0,0 +1,193 @@
+"""Contains tests for the demux module.
+"""
+import os
+import sys
+import math
+import random
+import unittest
+
+aries_parent = os.path.join(os.path.dirname(__file__), "..", "..")
+if aries_parent not in sys.path:
+    sys.path.append(aries_parent)
+import dnaio
+import parasail
+import editdistance
+from Cancer.fastq.demux import DemultiplexInlineWorker, DemultiplexDualIndexWorker
+
+BASES = "ACGT"
+
+
+def random_sequence(length):
+    return "".join(random.choice(BASES) for _ in range(length))
+
+
+def mutate(sequence, edits):
+    """Applies a number of random substitutions, insertions and deletions to a sequence.
+    """
+    sequence = list(sequence)
+    for _ in range(edits):
+        i = random.randrange(len(sequence))
+        edit = random.randrange(3)
+        if edit == 0:
+            sequence[i] = random.choice(BASES)
+        elif edit == 1:
+            sequence.insert(i, random.choice(BASES))
+        else:
+            del sequence[i]
+    return "".join(sequence)
+
+
+def trim_adapters_baseline(worker, read1, read2):
+    """Trims the adapters by aligning each adapter with parasail.sg_de_stats() without query profiles.
+    This is the original implementation of DemultiplexInlineWorker.trim_adapters().
+    """
+    reads = [read1, read2]
+    matched = [""] * len(reads)
+    for i in range(len(reads)):
+        read = reads[i]
+        for adapter in worker.adapters:
+            result = parasail.sg_de_stats(
+                adapter, read.sequence[:20], worker.penalty, worker.penalty, worker.score_matrix
+            )
+            if result.matches <= worker.min_match_length:
+                continue
+            distance = (worker.score * result.matches - result.score) / worker.penalty
+            max_distance = math.floor(len(adapter) * worker.error_rate)
+            if distance <= max_distance:
+                matched[i] = adapter
+                read.sequence = read.sequence[result.end_ref + 1:]
+                read.qualities = read.qualities[result.end_ref + 1:]
+                break
+    return matched[0], matched[1]
+
+
+class TestDemultiplexInlineWorker(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+
+    def random_read(self, adapters):
+        """Generates a read starting with an adapter with random edits, or a read without adapter.
+        """
+        choice = random.randrange(len(adapters) + 1)
+        if choice == len(adapters):
+            sequence = random_sequence(50)
+        else:
+            sequence = mutate(adapters[choice], random.randrange(4)) + random_sequence(40)
+        return dnaio.Sequence("read", sequence, "I" * len(sequence))
+
+    def assert_same_trimming(self, barcode_dict, read_count=3000):
+        worker = DemultiplexInlineWorker(barcode_dict)
+        adapters = list(barcode_dict.keys())
+        for _ in range(read_count):
+            read1 = self.random_read(adapters)
+            read2 = self.random_read(adapters)
+            expected1 = dnaio.Sequence(read1.name, read1.sequence, read1.qualities)
+            expected2 = dnaio.Sequence(read2.name, read2.sequence, read2.qualities)
+            expected = trim_adapters_baseline(worker, expected1, expected2)
+            self.assertEqual(worker.trim_adapters(read1, read2), expected)
+            self.assertEqual((read1.sequence, read1.qualities), (expected1.sequence, expected1.qualities))
+            self.assertEqual((read2.sequence, read2.qualities), (expected2.sequence, expected2.qualities))
+        return worker
+
+    def test_trim_adapters(self):
+        """Tests trimming the reads with the adapter profiles against the original alignments.
+        """
+        barcode_dict = {
+            "ACGTACGTAC": "S1",
+            "TTGCAAGGTC": "S2",
+            "GACTTGCA": "S3",
+        }
+        self.assert_same_trimming(barcode_dict)
+
+    def test_trim_adapters_reordered(self):
+        """Tests trimming the reads when the adapters are re-ordered by their hits.
+        """
+        barcode_dict = {
+            "AAAAAAAAAAAA": "S1",
+            "CCCCCCCCCCCC": "S2",
+            "GGGGGGGGGGGG": "S3",
+        }
+        reorder_interval = DemultiplexInlineWorker.REORDER_INTERVAL
+        DemultiplexInlineWorker.REORDER_INTERVAL = 10
+        try:
+            worker = self.assert_same_trimming(barcode_dict)
+        finally:
+            DemultiplexInlineWorker.REORDER_INTERVAL = reorder_interval
+        self.assertTrue(worker._adaptive)
+
+    def test_trim_adapters_overlapping(self):
+        """Tests trimming the reads when a read may match more than one adapter.
+        The adapters must be tried in the original order.
+        """
+        barcode_dict = {
+            "ACGTACGTAC": "S1",
+            "ACGTACGTTC": "S2",
+            "ACGTACGT": "S3",
+        }
+        worker = self.assert_same_trimming(barcode_dict)
+        self.assertFalse(worker._adaptive)
+
+
+def match_adapters_baseline(worker, barcode):
+    """Matches a barcode to the adapters by edit distance.
+    This is the original implementation of DemultiplexDualIndexWorker.match_adapters().
+    """
+    for adapter in worker.adapters:
+        mismatch = editdistance.eval(barcode, adapter)
+        if mismatch < worker.max_error.get(adapter, 0):
+            return adapter
+    return None
+
+
+class TestDemultiplexDualIndexWorker(unittest.TestCase):
+    DUAL_INDEX_BARCODES = {
+        "GCACAACT+CAAGTCGT": "S1",
+        "GCACAACT+CAAGTCGA": "S2",
+        "AAGGTTCC+ACGTACGT": "S3",
+        "NNNNNNNN+ACGTACGT": "S4",
+    }
+
+    def setUp(self):
+        random.seed(0)
+
+    def random_barcodes(self, adapters, count=3000):
+        """Generates barcodes by applying random edits to the adapters.
+        """
+        barcodes = list(adapters)
+        for _ in range(count):
+            barcode = mutate(random.choice(adapters), random.randrange(4))
+            if random.randrange(10) == 0 and barcode:
+                # Unknown or lowercase bases
+                i = random.randrange(len(barcode))
+                barcode = barcode[:i] + random.choice("Xa.") + barcode[i + 1:]
+            barcodes.append(barcode)
+        return barcodes
+
+    def assert_same_matching(self, barcode_dict, error_rate, packed):
+        worker = DemultiplexDualIndexWorker(barcode_dict, error_rate)
+        self.assertEqual(worker.packed_adapters is not None, packed)
+        for barcode in self.random_barcodes(list(barcode_dict.keys())):
+            expected = match_adapters_baseline(worker, barcode)
+            self.assertEqual(worker.match_adapters(barcode), expected, "Barcode: %s" % barcode)
+        return worker
+
+    def test_match_adapters_packed(self):
+        """Tests matching the barcodes by hamming distance of the packed barcodes,
+        i.e. the adapters have the same length and the max error is not greater than 2.
+        """
+        # Max error 1 and 2
+        for error_rate in [0.1, 0.15]:
+            self.assert_same_matching(self.DUAL_INDEX_BARCODES, error_rate, True)
+        self.assert_same_matching({"ACGTAC": "S1", "ACGTAA": "S2", "TTTTTT": "S3"}, 0.34, True)
+
+    def test_match_adapters_not_packed(self):
+        """Tests matching the barcodes when the adapters cannot be compared by hamming distance.
+        """
+        # Max error greater than 2
+        self.assert_same_matching(self.DUAL_INDEX_BARCODES, 0.2, False)
+        # Adapters with different lengths
+        self.assert_same_matching({"GCACAACT+CAAGTCGT": "S1", "GCACAACT+CAAGTCG": "S2"}, 0.1, False)
+        # Adapters with unknown bases
+        self.assert_same_matching({"GCACAACT+CAAGTCGT": "S1", "GCACAACT-CAAGTCGT": "S2"}, 0.1, False)
+        # Adapters longer than MAX_PACKED_LENGTH
+        self.assert_same_matching({"GCACAACTACG+CAAGTCGTAC": "S1", "AAGGTTCCACG+ACGTACGTAC": "S2"}, 0.1, False)
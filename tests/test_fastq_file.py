@@ -0,0 +1,248 @@
+"""Contains tests for the fastq_file module.
+"""
+import io
+import os
+import re
+import sys
+import gzip
+import zlib
+import shutil
+import random
+import tempfile
+import unittest
+from collections import Counter
+
+aries_parent = os.path.join(os.path.dirname(__file__), "..", "..")
+if aries_parent not in sys.path:
+    sys.path.append(aries_parent)
+import dnaio
+from Cancer.fastq_file import IlluminaFASTQ, RawGzipReader
+
+
+def gzip_member(data, flags=0, extra=b"", name=b"", comment=b""):
+    """Compresses data into a gzip member with the optional fields in the header.
+    """
+    header = b"\x1f\x8b\x08" + bytes([flags]) + b"\x00" * 4 + b"\x00\xff"
+    if flags & RawGzipReader.FEXTRA:
+        header += len(extra).to_bytes(2, "little") + extra
+    if flags & RawGzipReader.FNAME:
+        header += name + b"\0"
+    if flags & RawGzipReader.FCOMMENT:
+        header += comment + b"\0"
+    if flags & RawGzipReader.FHCRC:
+        header += (zlib.crc32(header) & 0xffff).to_bytes(2, "little")
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    trailer = zlib.crc32(data).to_bytes(4, "little") + (len(data) & 0xffffffff).to_bytes(4, "little")
+    return header + body + trailer
+
+
+def count_barcodes(data):
+    """Counts the raw dual index barcodes in FASTQ data line by line,
+    i.e. the last field (separated by ":") of each identifier line after stripping the whitespaces.
+    """
+    lines = data.split(b"\n")
+    if data.endswith(b"\n"):
+        lines.pop()
+    counter = Counter()
+    for line in lines[0::4]:
+        barcode = line.strip().split(b":")[-1]
+        if re.fullmatch(IlluminaFASTQ.dual_index_pattern.encode(), barcode):
+            counter[barcode] += 1
+    return counter
+
+
+class ShortReader(io.RawIOBase):
+    """Returns at most a few bytes on each read, like a pipe.
+    """
+    def __init__(self, data, size=3):
+        self._data = io.BytesIO(data)
+        self._size = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._data.readinto(memoryview(b)[:self._size])
+
+
+class TestBarcodeCounting(unittest.TestCase):
+    # Identifier lines, in which {} is replaced by a barcode
+    HEADERS = [
+        b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:{}",
+        b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:{} \t ",
+        b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:{}\r",
+        b"@:{}",
+        b"@{}",
+        b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 {}",
+        b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:{}A",
+        b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:A{}",
+        b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0: {}",
+        b"@NB552316:79:HNJJ3BGXG:1:11101:10002:13076/1",
+        b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:1",
+    ]
+    BARCODES = [b"GCACAACT+CAAGTCGT", b"AAAAAAAA+TTTTTTTT", b"NNNNNNNN+ACGTNACG", b"ACGTACGT+acgtacgt",
+                b"ACGTACGT-ACGTACGT", b"ACGTACG+TACGTACGT"]
+
+    def setUp(self):
+        random.seed(0)
+        self.temp_dir = tempfile.mkdtemp()
+        records = []
+        for _ in range(500):
+            header = random.choice(self.HEADERS).replace(b"{}", random.choice(self.BARCODES))
+            length = random.randrange(1, 30)
+            sequence = "".join(random.choice("ACGTN") for _ in range(length)).encode()
+            records.append(b"%s\n%s\n+\n%s\n" % (header, sequence, b"I" * length))
+        self.data = b"".join(records)
+        self.expected = count_barcodes(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def assert_counts(self, chunks, expected):
+        counter = Counter()
+        for chunk in chunks:
+            IlluminaFASTQ.merge_counts(counter, IlluminaFASTQ.count_chunk(chunk))
+        self.assertEqual(IlluminaFASTQ.unpack_barcodes(counter), expected)
+
+    def assert_chunks(self, chunks, data):
+        """Checks if the chunks contain the data and each chunk contains only complete reads.
+        """
+        chunks = [bytes(chunk) for chunk in chunks]
+        self.assertEqual(b"".join(chunks), data)
+        for chunk in chunks[:-1]:
+            self.assertTrue(chunk.endswith(b"\n"))
+            self.assertEqual(chunk.count(b"\n") % 4, 0)
+        self.assert_counts(chunks, count_barcodes(data))
+        return chunks
+
+    def map_chunks(self, data, chunk_size):
+        path = os.path.join(self.temp_dir, "test.fastq")
+        with open(path, "wb") as f:
+            f.write(data)
+        return list(IlluminaFASTQ.map_chunks(path, chunk_size))
+
+    def test_count_chunk(self):
+        self.assertTrue(self.expected)
+        self.assert_counts([self.data], self.expected)
+        # The last line does not end with a line break.
+        self.assert_counts([self.data.rstrip(b"\n")], self.expected)
+        # The last read contains only the identifier line.
+        header = b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:GCACAACT+CAAGTCGT"
+        self.assert_counts([self.data + header], count_barcodes(self.data + header))
+        self.assert_counts([b""], {})
+
+    def test_count_reads(self):
+        """Tests counting and grouping the reads parsed by dnaio,
+        the results should be the same as count_chunk() for identifiers ending with whitespaces.
+        """
+        headers = [
+            b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:GCACAACT+CAAGTCGT",
+            b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:GCACAACT+CAAGTCGT \t",
+            b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:GCACAACT+CAAGTCGT  ",
+            b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:AAAAAAAA+TTTTTTTT\t",
+            b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:AAAAAAAA+TTTTTTTT\r",
+            b"@NB552316:26:HWFLNBGXF:1:11101:26601:1229 1:N:0:AAAAAAAA+TTTTTTTTA \t",
+        ]
+        data = b"".join(b"%s\nACGT\n+\nIIII\n" % header for header in headers)
+        expected = {b"GCACAACT+CAAGTCGT": 3, b"AAAAAAAA+TTTTTTTT": 2}
+        self.assertEqual(count_barcodes(data), expected)
+        self.assert_counts([data], expected)
+        reads = [dnaio.Sequence(header[1:].decode(), "ACGT", "IIII") for header in headers]
+        fastq = IlluminaFASTQ(io.BytesIO(data))
+        self.assertEqual(fastq._count(reads), expected)
+        self.assertEqual(fastq._group(reads), {b"GCACAACT+CAAGTCGT": [1, 5, 9], b"AAAAAAAA+TTTTTTTT": [13, 17]})
+
+    def test_read_chunks(self):
+        # Chunk sizes smaller than a read, across the reads and larger than the data
+        for chunk_size in [1, 7, 50, 1000, len(self.data) + 1]:
+            for data in [self.data, self.data.rstrip(b"\n")]:
+                self.assert_chunks(IlluminaFASTQ.read_chunks(io.BytesIO(data), chunk_size), data)
+                self.assert_chunks(IlluminaFASTQ.read_chunks(ShortReader(data), chunk_size), data)
+        chunks = self.assert_chunks(IlluminaFASTQ.read_chunks(io.BytesIO(self.data), 1000), self.data)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(list(IlluminaFASTQ.read_chunks(io.BytesIO(b""), 1000)), [])
+
+    def test_map_chunks(self):
+        for chunk_size in [1, 7, 50, 1000, len(self.data) + 1]:
+            for data in [self.data, self.data.rstrip(b"\n")]:
+                self.assert_chunks(self.map_chunks(data, chunk_size), data)
+        chunks = self.assert_chunks(self.map_chunks(self.data, 1000), self.data)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(self.map_chunks(b"", 1000), [])
+
+
+class TestRawGzipReader(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = b"".join(
+            b"@READ%d 1:N:0:GCACAACT+CAAGTCGT\n%s\n+\n%s\n" % (
+                i, "".join(random.choice("ACGT") for _ in range(50)).encode(), b"I" * 50
+            ) for i in range(1000)
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_file(self, content):
+        path = os.path.join(self.temp_dir, "test.fastq.gz")
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def read_file(self, content, buffer_size=None):
+        """Decompresses the content with RawGzipReader, reading the file in blocks of buffer_size bytes.
+        """
+        path = self.write_file(content)
+        with RawGzipReader(path, buffer_size) as raw:
+            with io.BufferedReader(raw) as f:
+                return f.read()
+
+    def assert_decompressed(self, content, expected):
+        # Small buffer sizes split the gzip headers and trailers across the blocks.
+        for buffer_size in [None, 1, 7, 100]:
+            self.assertEqual(self.read_file(content, buffer_size), expected, "Buffer size: %s" % buffer_size)
+
+    def test_single_member(self):
+        self.assert_decompressed(gzip.compress(self.data), self.data)
+
+    def test_multiple_members(self):
+        half = len(self.data) // 2
+        content = gzip.compress(self.data[:half]) + gzip.compress(self.data[half:])
+        self.assert_decompressed(content, self.data)
+        # A member with no data
+        self.assert_decompressed(gzip.compress(self.data) + gzip.compress(b""), self.data)
+
+    def test_optional_header_fields(self):
+        flags = RawGzipReader.FEXTRA | RawGzipReader.FNAME | RawGzipReader.FCOMMENT | RawGzipReader.FHCRC
+        content = gzip_member(self.data, flags, extra=b"EX\x02\x00ab", name=b"test.fastq", comment=b"Test")
+        self.assert_decompressed(content, self.data)
+        self.assertEqual(gzip.decompress(content), self.data)
+        content = gzip_member(self.data, RawGzipReader.FNAME, name=b"test.fastq") + gzip_member(
+            self.data, RawGzipReader.FEXTRA, extra=b"\0" * 10
+        )
+        self.assert_decompressed(content, self.data * 2)
+
+    def test_zero_padding(self):
+        self.assert_decompressed(gzip.compress(self.data) + b"\0" * 1000, self.data)
+        content = gzip.compress(self.data) + b"\0" * 3 + gzip.compress(self.data) + b"\0"
+        self.assert_decompressed(content, self.data * 2)
+
+    def test_empty_file(self):
+        self.assert_decompressed(b"", b"")
+
+    def test_truncated_file(self):
+        content = gzip.compress(self.data)
+        # Truncated in the compressed data, the trailer and the header
+        for size in [len(content) // 2, len(content) - 4, 5]:
+            with self.assertRaises(EOFError):
+                self.read_file(content[:size])
+        with self.assertRaises(EOFError):
+            self.read_file(gzip_member(self.data, RawGzipReader.FNAME, name=b"test.fastq")[:15])
+
+    def test_not_gzip_file(self):
+        with self.assertRaises(OSError):
+            self.read_file(self.data)
+        with self.assertRaises(OSError):
+            self.read_file(gzip.compress(self.data) + b"Not a gzip member")